@@ -0,0 +1,124 @@
+from typing import Optional
+from pathlib import Path
+import threading
+import sqlite3
+import time
+import os
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+def cache_dir() -> Path:
+    return Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "mod-auto-download"
+
+
+def default_cache_path() -> Path:
+    return cache_dir() / "api.sqlite"
+
+
+class CachedSession(requests.Session):
+    """
+    带有磁盘缓存的会话
+
+    Modrinth 的项目与版本信息变化不频繁，在有效期内直接使用缓存，
+    过期后带上 ETag 重新验证，未变化时服务器只会返回 304
+    """
+
+    # 只缓存此前缀下的请求，文件下载不应该进入缓存
+    prefix: str
+    # 缓存有效期（秒）
+    ttl: float
+
+    def __init__(self, prefix: str, path: Optional[Path] = None, ttl: float = 3600) -> None:
+        super().__init__()
+        self.prefix = prefix
+        self.ttl = ttl
+
+        path = path or default_cache_path()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # 多个线程共用一个连接，由锁保证串行访问
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db_lock = threading.Lock()
+        with self.db_lock, self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, etag TEXT, body BLOB, ts REAL)"
+            )
+
+    def request(self, method, url, params=None, **kwargs) -> requests.Response:
+        if method.upper() != "GET" or kwargs.get("stream") or not str(url).startswith(self.prefix):
+            return super().request(method, url, params, **kwargs)
+
+        key = self.cache_key(url, params)
+        cached = self.lookup(key)
+
+        if cached:
+            etag, body, ts = cached
+            # 还在有效期内，不需要请求
+            if time.time() - ts < self.ttl:
+                return self.cached_response(key, body, etag)
+            if etag:
+                headers = dict(kwargs.pop("headers", None) or {})
+                headers["If-None-Match"] = etag
+                kwargs["headers"] = headers
+
+        result = super().request(method, url, params, **kwargs)
+
+        if cached and result.status_code == 304:
+            etag, body, _ = cached
+            self.store(key, result.headers.get("ETag", etag), body)
+            return self.cached_response(key, body, etag)
+
+        if result.status_code == 200:
+            self.store(key, result.headers.get("ETag"), result.content)
+
+        return result
+
+    def cache_key(self, url, params=None) -> str:
+        return requests.Request("GET", url, params=params).prepare().url or str(url)
+
+    def fresh(self, url, params=None) -> Optional[requests.Response]:
+        """
+        有效期内的缓存，不会发出请求
+
+        return: 没有缓存或缓存已过期时为 None
+        """
+
+        if not str(url).startswith(self.prefix):
+            return None
+
+        key = self.cache_key(url, params)
+        cached = self.lookup(key)
+        if cached and time.time() - cached[2] < self.ttl:
+            etag, body, _ = cached
+            return self.cached_response(key, body, etag)
+        return None
+
+    def lookup(self, key: str) -> Optional[tuple[Optional[str], bytes, float]]:
+        with self.db_lock:
+            return self.db.execute("SELECT etag, body, ts FROM entries WHERE key = ?", (key,)).fetchone()
+
+    def store(self, key: str, etag: Optional[str], body: bytes):
+        with self.db_lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries (key, etag, body, ts) VALUES (?, ?, ?, ?)",
+                (key, etag, body, time.time())
+            )
+
+    def clear(self):
+        with self.db_lock, self.db:
+            self.db.execute("DELETE FROM entries")
+
+    def cached_response(self, url: str, body: bytes, etag: Optional[str]) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = "OK"
+        response.url = url
+        response.encoding = "utf-8"
+        response.headers = CaseInsensitiveDict({"ETag": etag} if etag else {})
+        response._content = body
+        return response
+
+    def close(self):
+        super().close()
+        with self.db_lock:
+            self.db.close()
@@ -22,10 +22,14 @@ def get_mod(
     require_server: bool = False, 
     allow_optional_mod: bool = False, 
     threads: int = 4,
-    console: Console = Console()
+    console: Console | None = None,
+    max_requests: int | None = None,
+    use_cache: bool = True,
+    max_downloads: int | None = None
 ):
+    console = console or Console()
     try:
-        with ModManager(threads, console) as mm:
+        with ModManager(threads, console, max_requests, use_cache, max_downloads) as mm:
             mm.mods = mods
 
             if exhaust(mm.init_mod(game_version, loader, require_client, require_server)):
@@ -34,8 +38,7 @@ def get_mod(
                 return
             if exhaust(mm.resolve_dependencies(allow_optional_mod)):
                 return
-            if exhaust(mm.get_download_link()):
-                return
+            # 下载链接在下载各个模组时顺带获取
             if exhaust(mm.download_mods(download_dir)):
                 return
 
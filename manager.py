@@ -1,19 +1,30 @@
-from typing import Generator, Literal, Sequence
-from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import BinaryIO, Callable, Generator, Iterable, Literal, Optional, Sequence
+from contextlib import contextmanager
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from itertools import islice
 import threading
-import networkx as nx
 import requests
+from requests.adapters import HTTPAdapter
 from rich.progress import Progress, DownloadColumn, TextColumn, BarColumn, TransferSpeedColumn, MofNCompleteColumn, TaskID
 from rich.console import Console
 from rich.tree import Tree
+from rich.traceback import Traceback
 from pyvis.network import Network
 from pathlib import Path
 import hashlib
-from io import BytesIO
+import pickle
+import json
 import time
+import os
 
 from moderr import ModError, ModNotFoundError, ModIncompatibleError
-from mod import Mod, Dep
+from mod import API, TIMEOUT, USER_AGENT, Mod, Dep, fetch_projects, fetch_versions
+from cache import CachedSession, cache_dir
+
+
+# 令牌桶允许突发的请求轮数，每轮是同时进行的请求数上限
+BURST_ROUNDS = 4
 
 
 class RateLimiter:
@@ -21,36 +32,153 @@ class RateLimiter:
     Modrinth 的接口是有速率限制的
     """
 
-    rate_limit: float
-    last_req: float
-
-    def __init__(self, req_per_min: int) -> None:
-        self.rate_limit = 60 / req_per_min
-        self.last_req = 0.0
+    # 令牌桶，允许在限额内突发请求
+    capacity: float
+    # 每秒补充的令牌数
+    refill_rate: float
+    tokens: float
+    last_refill: float
+    # 同时进行中的请求数上限，与线程数无关
+    inflight: threading.BoundedSemaphore
+    # 同时进行中的文件下载数上限，与 API 请求分开，避免 API 请求排在耗时的下载后面
+    downloads: threading.BoundedSemaphore
+
+    def __init__(self, req_per_min: int, max_inflight: int = 4, max_downloads: int | None = None) -> None:
+        # 只允许几轮并发请求的突发，补充速度扣除这部分，
+        # 这样一分钟内最多 capacity + 60 * refill_rate = req_per_min 个请求，不会超出限额
+        # 突发最多占一半限额，补充速度不会是 0
+        self.capacity = min(max_inflight * BURST_ROUNDS, req_per_min // 2)
+        self.refill_rate = (req_per_min - self.capacity) / 60
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
         # 为并发加锁
         self.lock = threading.Lock()
+        self.inflight = threading.BoundedSemaphore(max_inflight)
+        self.downloads = threading.BoundedSemaphore(max_downloads or max_inflight)
 
     def wait(self):
-        # 等待锁
+        # 只在锁内计算，等待时不持有锁
         with self.lock:
-            now = time.time()
-            delta = now - self.last_req
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_rate)
+            self.last_refill = now
+            # 令牌不够时预支一个，等到它补充上为止
+            self.tokens -= 1
+            delay = -self.tokens / self.refill_rate if self.tokens < 0 else 0
+
+        if delay:
+            time.sleep(delay)
+
+    @contextmanager
+    def slot(self):
+        """
+        占用一个 API 请求名额并计入速率限制，在整个请求期间（包括读取响应体）持有
+        """
+
+        with self.inflight:
+            self.wait()
+            yield
+
+    @contextmanager
+    def download_slot(self):
+        """
+        占用一个文件下载名额，CDN 上的文件下载不受 API 的速率限制，与 API 请求的名额分开
+        """
+
+        with self.downloads:
+            yield
+
+# 依赖解析结果的缓存有效期（秒）
+GRAPH_TTL = 3600
 
-            if delta < self.rate_limit:
-                time.sleep(self.rate_limit - delta)
+# 下载时每次读取的块大小
+CHUNK_SIZE = 1 << 16
+# 超过此大小的文件会分段并发下载
+RANGE_THRESHOLD = 8 << 20
+# 分段下载时每段的大小
+RANGE_SIZE = 4 << 20
+# 单个文件最多同时下载的段数
+RANGE_PARTS = 4
+# 每读取这么多块才更新一次下载进度
+PROGRESS_EVERY = 16
 
-            self.last_req = time.time()
+
+def iter_chunks(r: requests.Response, advance: Callable[[int], None]) -> Generator[bytes, None, None]:
+    """
+    逐块读取响应体，积攒若干块后才更新一次进度，减少各线程争抢进度条的锁
+    """
+
+    pending = 0
+    for i, chunk in enumerate(r.iter_content(chunk_size=CHUNK_SIZE), 1):
+        if not chunk:
+            continue
+        yield chunk
+        pending += len(chunk)
+        if i % PROGRESS_EVERY == 0:
+            advance(pending)
+            pending = 0
+    if pending:
+        advance(pending)
+
+
+def preallocate(f: BinaryIO, size: int):
+    """
+    按文件的最终大小预先分配磁盘空间，写入时文件不必一点点扩展
+    """
+
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            # 有的文件系统不支持，退回到 truncate
+            pass
+    f.truncate(size)
+
+def describe_error(error: Exception) -> Tree | str:
+    """
+    错误在汇总信息中的样子，已经构建好的树直接使用
+    """
+
+    if len(error.args) == 1 and isinstance(error.args[0], Tree):
+        return error.args[0]
+    return f"[yellow]{error}[/yellow]"
 
 ProgressGen = Generator[tuple[int, float | None, str | None], None, Sequence[Exception]]
 
 class ModManager:
+    __slots__ = (
+        "rl",
+        "use_cache",
+        "__pool",
+        "session",
+        "console",
+        "mods",
+        "target_version",
+        "target_loader",
+        "require_client",
+        "require_server",
+        "finalmsg",
+        "met_condition",
+        "all_mods",
+        "prefetched_versions",
+        "graph_future",
+        "fatal",
+        "progress",
+        "max_pending",
+    )
+
     # 限制请求速率
     rl: RateLimiter
+    # 是否缓存 API 响应与依赖解析结果
+    use_cache: bool
     # 维护一个线程池来并发请求
     __pool: ThreadPoolExecutor
+    # 所有请求共用的连接池，避免每次请求都重新握手
+    session: requests.Session
     console: Console
     # 需要的模组
-    mods: list[Mod] = []
+    mods: list[Mod]
     target_version: str
     target_loader: str
     require_client: bool 
@@ -65,53 +193,171 @@ class ModManager:
     # 包含依赖的所有模组
     all_mods: dict[str, Mod]
 
-    def __init__(self, threads: int = 4, console: Console = Console()) -> None:
+    # init_mod 时与项目信息同时请求的版本列表
+    prefetched_versions: dict[str, Future[Optional[list[dict]]]]
+
+    # 正在后台写入的依赖图
+    graph_future: Optional[Future[None]]
+
+    # 无法处理的异常，finish 清理完成后重新抛出
+    fatal: list[Exception]
+
+    # 各阶段共用的进度条
+    progress: Progress
+
+    # 同时提交到线程池的任务数上限
+    max_pending: int
+
+    def __init__(self, threads: int = 4, console: Console | None = None, max_requests: int | None = None, use_cache: bool = True, max_downloads: int | None = None) -> None:
         self.__pool = ThreadPoolExecutor(threads)
-        self.console = console
+        # 保证线程不会空闲，又不会一次创建所有任务
+        self.max_pending = threads * 2
+        self.use_cache = use_cache
+        # 默认同时进行的请求数与线程数相同
+        max_requests = max_requests or threads
+        max_downloads = max_downloads or max_requests
+        # API 的响应会缓存到磁盘，重复运行时无需再次请求
+        self.session = CachedSession(API) if use_cache else requests.Session()
+        # 每个域名（API 与 CDN）各有一个连接池，池子的大小与同时进行的请求数一致，保证每个请求都能复用连接
+        # 保留的域名连接池数量用默认值即可，不能按线程数设置，否则线程少时两个域名的连接池会互相挤掉
+        adapter = HTTPAdapter(pool_maxsize=max(max_requests, max_downloads))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["User-Agent"] = USER_AGENT
+        self.console = console or Console()
+        self.progress = Progress(
+            TextColumn("[progress.description]{task.description}"),
+            BarColumn(),
+            MofNCompleteColumn(),
+            console=self.console
+        )
         self.mods = []
         self.all_mods = {}
+        self.prefetched_versions = {}
+        self.graph_future = None
+        self.fatal = []
         self.finalmsg = []
         self.met_condition = set()
-        self.rl = RateLimiter(300)
+        # 同时进行的文件下载数可以单独设置，默认与 API 请求数相同
+        self.rl = RateLimiter(300, max_requests, max_downloads)
         # self.__cached_mods = []
 
     def __enter__(self):
-        self.finalmsg = []
+        self.finalmsg.clear()
         return self
 
     def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            # 已经有异常在传播，不要用记录的异常替换它
+            self.fatal.clear()
         self.finish()
 
         return False
 
     def finish(self):
+        # 等待后台的依赖图写入完成
+        if self.graph_future and not self.graph_future.cancelled():
+            try:
+                self.graph_future.result()
+            except Exception as e:
+                self.finalmsg.append(f"[yellow]警告 依赖图保存失败 {e}[/yellow]")
+            else:
+                # 确实写入之后才提示，写入失败或被取消时不会出现
+                self.finalmsg.append("依赖图已保存")
+            self.graph_future = None
+
         self.__pool.shutdown()
+        self.session.close()
+        self.progress.stop()
 
         for msg in self.finalmsg:
             self.console.print(msg)
-        self.finalmsg = []
-        self.met_condition = set()
+        self.finalmsg.clear()
+        self.met_condition.clear()
+
+        if self.fatal:
+            # 清理完成后重新抛出，由调用者决定如何处理
+            # 阶段遇到第一个无法处理的异常就会停止，其余的异常只输出
+            exc, *others = self.fatal
+            self.fatal.clear()
+            for other in others:
+                self.console.line()
+                self.console.print(Traceback.from_exception(type(other), other, other.__traceback__))
+            raise exc
+
+    @contextmanager
+    def phase_progress(self) -> Generator[Progress, None, None]:
+        """
+        各阶段共用同一个进度条，第一次使用时启动，finish 时才停止
+        """
 
-    def handle_future(self, futures: list[Future], progress: Progress, task_id: TaskID) -> Generator[tuple[int, float | None, str | None], None, list[ModError]]:
-        errors: list[ModError] = []
-        for future in as_completed(futures):
-            message = None
-            try:
-                message = future.result()
-            except ModError as e:
-                message = f"[yellow]警告 {e}[/yellow]"
-                progress.print(message)
-                errors.append(e)
-            except Exception:
-                # 真的很异常的异常应当上报
-                progress.stop()
-                self.__pool.shutdown()
+        if not self.progress.live.is_started:
+            self.progress.start()
+        yield self.progress
 
-                raise
-            finally:
-                progress.update(task_id, advance=1)
-                yield (1, progress.tasks[task_id].total, message)
-        return errors
+    def abort(self, progress: Progress):
+        """
+        遇到无法处理的异常时停止进度条，并取消还没开始的任务，不必等它们全部跑完
+        """
+
+        progress.stop()
+        self.__pool.shutdown(wait=False, cancel_futures=True)
+
+    def record_fatal(self, progress: Progress, exc: Exception):
+        """
+        记录无法处理的异常并中止当前阶段，异常在 finish 清理完成后重新抛出
+        """
+
+        self.abort(progress)
+        self.fatal.append(exc)
+
+    def report_errors(self, errors: Sequence[Exception], title: str = "由于以下原因，将不会继续", describe: Callable[[Exception], Tree | str] = describe_error):
+        """
+        把阶段中遇到的错误汇总到最后输出的信息中
+
+        describe: 把每个错误转换为树中的一项
+        """
+
+        # 无法处理的异常会在 finish 时重新抛出，不在这里重复输出
+        errors = [error for error in errors if error not in self.fatal]
+        if errors:
+            e_tree = Tree(title)
+            for error in errors:
+                e_tree.add(describe(error))
+            self.finalmsg.append(e_tree)
+
+    def handle_future(self, fn: Callable[[Mod], str], mods: Iterable[Mod], progress: Progress, task_id: TaskID) -> Generator[tuple[int, float | None, str | None], None, list[Exception]]:
+        """
+        对每个模组在线程池中执行 fn，同时提交的任务不超过 max_pending 个，完成一个才提交下一个
+        """
+
+        errors: list[Exception] = []
+        # 总数在阶段中不会变化，不必每次都从进度条中取
+        total = progress.tasks[task_id].total
+        mods = iter(mods)
+        pending: set[Future[str]] = set()
+        while True:
+            for mod in islice(mods, self.max_pending - len(pending)):
+                pending.add(self.__pool.submit(fn, mod))
+            if not pending:
+                return errors
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                message = None
+                try:
+                    message = future.result()
+                except ModError as e:
+                    message = f"[yellow]警告 {e}[/yellow]"
+                    progress.print(message)
+                    errors.append(e)
+                except Exception as e:
+                    # 真的很异常的异常应当上报，留到 finish 清理完成后重新抛出
+                    self.record_fatal(progress, e)
+                    return [e]
+                finally:
+                    progress.update(task_id, advance=1)
+                    yield (1, total, message)
 
     def init_mod(self, version: str, loader: str, require_client: bool, require_server: bool) -> ProgressGen:
         """
@@ -127,27 +373,38 @@ class ModManager:
         self.target_loader = loader
 
         errors: list[ModError] = []
-        with Progress(
-            TextColumn("[progress.description]{task.description}"),
-            BarColumn(),
-            MofNCompleteColumn(),
-            console=self.console
-        ) as progress:
+        with self.phase_progress() as progress:
             task_id = progress.add_task("解析模组", True, len(self.mods))
 
-            # 多线程初始化
-            result = yield from self.handle_future(
-                [self.__pool.submit(mod.init, self.target_version, self.target_loader, require_client, require_server, progress, self.rl) for mod in self.mods], 
-                progress, 
-                task_id
-            )
-            errors.extend(result)
+            # 版本接口也接受 slug，不必等到项目信息返回，直接与其同时请求
+            self.prefetched_versions = {
+                mod.slug_or_id: self.__pool.submit(fetch_versions, mod.slug_or_id, version, loader, self.rl, self.session)
+                for mod in self.mods
+            }
 
-        if errors:
-            e_tree = Tree("由于以下原因，将不会继续")
-            for error in errors:
-                e_tree.add(f"[yellow]{error}[/yellow]")
-            self.finalmsg.append(e_tree)
+            # 批量获取所有模组的信息，而不是每个模组一次请求
+            try:
+                projects = fetch_projects([mod.slug_or_id for mod in self.mods], self.rl, self.session)
+            except Exception as e:
+                self.record_fatal(progress, e)
+                return [e]
+
+            for mod in self.mods:
+                message = None
+                try:
+                    project = projects.get(mod.slug_or_id) or projects.get(mod.slug_or_id.lower())
+                    if project is None:
+                        raise ModNotFoundError(f"无法找到模组 {mod.slug_or_id}", mod)
+                    message = mod.load(project, self.target_version, self.target_loader, require_client, require_server, progress)
+                except ModError as e:
+                    message = f"[yellow]警告 {e}[/yellow]"
+                    progress.print(message)
+                    errors.append(e)
+                finally:
+                    progress.update(task_id, advance=1)
+                    yield (1, len(self.mods), message)
+
+        self.report_errors(errors)
         return errors
 
     def check_version(self) -> ProgressGen:
@@ -158,27 +415,19 @@ class ModManager:
         """
 
         errors: list[ModError] = []
-        with Progress(
-            TextColumn("[progress.description]{task.description}"),
-            BarColumn(),
-            MofNCompleteColumn(),
-            console=self.console
-        ) as progress:
+        with self.phase_progress() as progress:
             task_id = progress.add_task("搜索版本", True, len(self.mods))
 
+            def query(mod: Mod) -> str:
+                # 优先使用 init_mod 时预先请求的版本列表
+                prefetched = self.prefetched_versions.pop(mod.slug_or_id, None)
+                return mod.query_version(progress, self.rl, self.session, prefetched.result() if prefetched else None)
+
             # 多线程检查版本可用性
-            result = yield from self.handle_future(
-                [self.__pool.submit(mod.query_version, progress, self.rl) for mod in self.mods], 
-                progress, 
-                task_id
-            )
+            result = yield from self.handle_future(query, self.mods, progress, task_id)
             errors.extend(result)
 
-        if errors:
-            e_tree = Tree("由于以下原因，将不会继续")
-            for error in errors:
-                e_tree.add(f"[yellow]{error}[/yellow]")
-            self.finalmsg.append(e_tree)
+        self.report_errors(errors)
         return errors
 
     def resolve_dependencies(self, allow_optional_mod: bool = False) -> ProgressGen:
@@ -188,11 +437,67 @@ class ModManager:
         return: 是否应该继续
         """
 
+        # 模组清单、目标版本都没有变化时，直接使用上次的解析结果
+        snapshot = self.graph_snapshot_path(allow_optional_mod) if self.use_cache else None
+        if snapshot and snapshot.exists() and time.time() - snapshot.stat().st_mtime < GRAPH_TTL:
+            try:
+                with open(snapshot, "rb") as f:
+                    self.all_mods = pickle.load(f)
+            except Exception:
+                snapshot.unlink(missing_ok=True)
+            else:
+                self.finalmsg.append("使用缓存的依赖解析结果")
+                return []
+
         # 用内置类型先存储图的信息，方便进行修改
         # 项目ID: 信息
         nodes: dict[str, Mod] = {}
-        # (依赖项目ID, 父项目ID, 信息)
-        edges: list[tuple[str, str, Dep]] = []
+        # 依赖项目ID: [(父项目ID, 信息)]，按依赖分组，删除某个依赖时不必遍历所有边
+        out_edges: defaultdict[str, list[tuple[str, Dep]]] = defaultdict(list)
+
+        def only_optional(id: str) -> bool:
+            """
+            需要此模组的都只是可选依赖
+            """
+
+            pairs = out_edges.get(id)
+            if not pairs:
+                return False
+            # 遇到非可选依赖立即返回
+            for _, dep in pairs:
+                if dep.dep_type != "optional":
+                    return False
+            return True
+
+        def required_by(id: str) -> list[str]:
+            """
+            以必要或可选依赖的形式需要此模组的模组
+            """
+
+            return [v for v, dep in out_edges[id] if dep.dep_type == "required" or dep.dep_type == "optional"]
+
+        def title(id: str) -> str:
+            """
+            模组的名称，项目不存在的模组不在节点中，只能显示ID
+            """
+
+            mod = nodes.get(id)
+            return mod.title() if mod else id
+
+        def dependents_tree(id: str) -> Tree | str | None:
+            """
+            说明有哪些模组需要此模组，没有时为 None
+            """
+
+            dependents = required_by(id)
+            if not dependents:
+                return None
+            if len(dependents) > 1:
+                tree = Tree("但是以下模组依赖它")
+                for dependent in dependents:
+                    tree.add(title(dependent))
+                return tree
+            return f"但是 {title(dependents[0])} 依赖它"
 
         edge_style: dict[
             Literal["required", "optional", "incompatible", "embedded"], 
@@ -221,90 +526,120 @@ class ModManager:
         }
 
         errors: list[ModError] = []
-        with Progress(
-            TextColumn("[progress.description]{task.description}"),
-            BarColumn(),
-            MofNCompleteColumn(),
-            console=self.console
-        ) as progress:
+        with self.phase_progress() as progress:
             task_id = progress.add_task("解析依赖", True, total=None)
 
-            mods_next_pre: dict[str, Dep]
-            mods_next: list[Mod]
-
             def resolve(mod: Mod) -> tuple[Mod, list[Dep], str]:
-                progress.print(f"解析 [bright_black]{mod.title()} {mod.version()}[/bright_black]")
-                return (mod, list(mod.dependencies(self.rl)), f"解析 {mod.title()} {mod.version()}")
-
-            mods_cur = self.mods.copy()
-            while mods_cur:
-                mods_next_pre = {}
-                mods_next = []
-
-                # 多线程解析依赖
-                futures = [self.__pool.submit(resolve, mod) for mod in mods_cur]
-
-                for future in as_completed(futures):
-                    try:
-                        mod, deps, message = future.result()
-                        nodes[mod.id()] = mod
-                        for dep in deps:
-                            if not allow_optional_mod and dep.dep_type == "optional":
-                                continue
-                            edges.append((
-                                dep.id,
-                                mod.id(),
-                                dep
-                            ))
-                            if dep.id not in nodes and dep.id not in mods_next_pre:
-                                mods_next_pre[dep.id] = dep
-                    except ModError as e:
-                        message = f"[yellow]警告 {e}[/yellow]"
-                        progress.print(message)
-                        errors.append(e)
-                    except Exception:
-                        progress.stop()
-                        self.__pool.shutdown()
-
-                        raise
-                    finally:
-                        progress.update(task_id, advance=1)
-                        yield (1, progress.tasks[task_id].total, message)
-
-                futures = [self.__pool.submit(dep.to_mod, rl=self.rl) for dep in mods_next_pre.values()]
-
-                for future in as_completed(futures):
-                    try:
-                        mod = future.result()
-                        if mod.id() not in nodes:
-                            nodes[mod.id()] = mod
-                            mods_next.append(mod)
-                    except ModError as e:
-                        message = f"[yellow]警告 {e}[/yellow]"
-                        progress.print(message)
-                        if isinstance(e, ModNotFoundError):
-                            not_required_actually = all(dep.dep_type == "optional" for u, _, dep in edges if u == e.except_mod.id()) and any(dep.dep_type == "optional" for u, _, dep in edges if u == e.except_mod.id())
-                            if not_required_actually:
-                                self.finalmsg.append(f"[yellow]{e}，但是所有需要它的模组都不是强制需求，已从依赖中删除此模组[/yellow]")
-                                edges = [(u, v, dep) for u, v, dep in edges if u != e.except_mod.id()]
-                                continue
-                            nodes[e.except_mod.id()] = e.except_mod
-                        errors.append(e)
-                        yield (0, progress.tasks[task_id].total, message)
-                    except Exception:
-                        progress.stop()
-                        self.__pool.shutdown()
-
-                        raise
-
-                mods_cur = mods_next
+                name = f"{mod.title()} {mod.version()}"
+                progress.print(f"解析 [bright_black]{name}[/bright_black]")
+                return (mod, list(mod.dependencies(self.rl, self.session)), f"解析 {name}")
+
+            def load(dep: Dep, project: Optional[dict], versions: Future[Optional[list[dict]]]) -> Mod:
+                # 批量请求中没有返回它，说明项目不存在，不必再单独请求一次
+                if project is None:
+                    raise ModNotFoundError(f"无法找到模组 {dep.id}", Mod(dep.id))
+                return dep.to_mod(rl=self.rl, session=self.session, project=project, versions=versions.result())
+
+            # 所有任务共用一个池子，一个模组解析完就立即安排它的依赖，不必等同一层的其他模组
+            pending: dict[Future, Literal["resolve", "projects", "to_mod"]] = {self.__pool.submit(resolve, mod): "resolve" for mod in self.mods}
+            # 批量获取项目信息的任务所对应的依赖，以及与之同时请求的版本列表
+            batches: dict[Future, list[tuple[Dep, Future[Optional[list[dict]]]]]] = {}
+            # 已经安排过解析的模组，避免菱形依赖中的公共依赖被重复请求
+            scheduled: set[str] = {mod.id() for mod in self.mods}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                # 这一轮新发现的依赖，之后一起批量获取项目信息
+                new_deps: list[Dep] = []
+
+                for future in done:
+                    # 出错时 future.result() 不会给 message 赋值，每个任务都要先重置
+                    message = None
+                    match pending.pop(future):
+                        case "resolve":
+                            try:
+                                mod, deps, message = future.result()
+                                mod_id = mod.id()
+                                nodes[mod_id] = mod
+                                for dep in deps:
+                                    dep_id = dep.id
+                                    if not allow_optional_mod and dep.dep_type == "optional":
+                                        continue
+                                    out_edges[dep_id].append((mod_id, dep))
+                                    if dep_id not in scheduled:
+                                        scheduled.add(dep_id)
+                                        new_deps.append(dep)
+                            except ModError as e:
+                                message = f"[yellow]警告 {e}[/yellow]"
+                                progress.print(message)
+                                errors.append(e)
+                            except Exception as e:
+                                self.record_fatal(progress, e)
+                                return [e]
+                            finally:
+                                progress.update(task_id, advance=1)
+                                # 依赖的总数在解析完成之前是未知的
+                                yield (1, None, message)
+
+                        case "projects":
+                            try:
+                                projects = future.result()
+                            except Exception as e:
+                                self.record_fatal(progress, e)
+                                return [e]
+                            for dep, versions in batches.pop(future):
+                                pending[self.__pool.submit(load, dep, projects.get(dep.id), versions)] = "to_mod"
+
+                        case "to_mod":
+                            try:
+                                mod = future.result()
+                                mod_id = mod.id()
+                                if mod_id not in nodes:
+                                    nodes[mod_id] = mod
+                                    pending[self.__pool.submit(resolve, mod)] = "resolve"
+                            except ModError as e:
+                                message = f"[yellow]警告 {e}[/yellow]"
+                                progress.print(message)
+                                if isinstance(e, ModNotFoundError):
+                                    # 依赖模组是用项目ID创建的，slug_or_id 就是项目ID
+                                    missing_id = e.except_mod.slug_or_id
+                                    if only_optional(missing_id):
+                                        self.finalmsg.append(f"[yellow]{e}，但是所有需要它的模组都不是强制需求，已从依赖中删除此模组[/yellow]")
+                                        del out_edges[missing_id]
+                                        # 之后如果有模组强制依赖它，需要重新解析并报告
+                                        scheduled.discard(missing_id)
+                                        continue
+                                    # 项目不存在时没有项目信息，不能作为节点，依赖图中只显示它的ID
+                                    try:
+                                        e.except_mod.project_data()
+                                    except ModError:
+                                        pass
+                                    else:
+                                        nodes[missing_id] = e.except_mod
+                                errors.append(e)
+                                yield (0, None, message)
+                            except Exception as e:
+                                self.record_fatal(progress, e)
+                                return [e]
+
+                if new_deps:
+                    # 一次请求获取这一轮所有新依赖的项目信息
+                    future = self.__pool.submit(fetch_projects, [dep.id for dep in new_deps], self.rl, self.session)
+                    # 版本列表只需要项目ID，与项目信息同时请求
+                    # 它们在 load 之前提交，线程池按顺序执行，所以 load 等待它们时不会占满线程池
+                    batches[future] = [
+                        (dep, self.__pool.submit(fetch_versions, dep.id, dep.target_version, dep.target_loader, self.rl, self.session))
+                        for dep in new_deps
+                    ]
+                    pending[future] = "projects"
 
             progress.update(task_id, completed=len(nodes), total=len(nodes))
 
-        # 创建有向图
-        dependencies: nx.DiGraph[str] = nx.DiGraph()
+        # 依赖图的节点与边，直接交给 pyvis 绘制
+        graph_nodes: dict[str, dict] = {}
+        graph_edges: list[tuple[str, str, dict]] = []
 
-        required_mods = [mod.id() for mod in self.mods]
+        # 清单中模组的ID，用集合查找，不必每个节点都遍历一次清单
+        required_mods = {mod.id() for mod in self.mods}
 
         # 存入节点
         for id, mod in nodes.items():
@@ -318,71 +653,54 @@ class ModManager:
             else:
                 if id in required_mods:
                     attrs["color"] = "green"
-                elif all(dep.dep_type == "optional" for u, _, dep in edges if u == id) and any(dep.dep_type == "optional" for u, _, dep in edges if u == id):
+                elif only_optional(id):
                     attrs["color"] = "lightgrey"
                 else:
                     attrs["color"] = "lightgreen"
 
             self.all_mods[id] = mod
-            dependencies.add_node(id, **attrs)
+            graph_nodes[id] = attrs
 
-        # 存入边
+        # 存入边，同时找出不兼容的模组
         incompatibles: dict[str, list[str]] = {}
-        for u, v, dep in edges:
-            self.met_condition.add(dep.dep_type)
-            attrs = edge_style[dep.dep_type]
-            dependencies.add_edge(u, v, **attrs)
-            if dep.dep_type == "incompatible":
-                incompatibles[u] = incompatibles.get(u, [])
-                incompatibles[u].append(v)
+        for u, pairs in out_edges.items():
+            for v, dep in pairs:
+                self.met_condition.add(dep.dep_type)
+                graph_edges.append((u, v, edge_style[dep.dep_type]))
+                if dep.dep_type == "incompatible":
+                    incompatibles.setdefault(u, []).append(v)
 
         for id, deps in incompatibles.items():
             root: Tree
             if len(deps) > 1:
-                root = Tree(f"[yellow]{nodes[id].title()} 与多个模组不兼容[/yellow]")
+                root = Tree(f"[yellow]{title(id)} 与多个模组不兼容[/yellow]")
                 for dep in deps:
-                    root.add(f"[yellow]不兼容 {nodes[dep].title()}[/yellow]")
+                    root.add(f"[yellow]不兼容 {title(dep)}[/yellow]")
             else:
-                root = Tree(f"[yellow]{nodes[id].title()} 与 {nodes[deps[0]].title()} 不兼容[/yellow]")
-            the_mods_that_require_this_one = [_v for _u, _v, _dep in edges if _u == id and (_dep.dep_type == "required" or _dep.dep_type == "optional")]
-            if the_mods_that_require_this_one:
-                if len(the_mods_that_require_this_one) > 1:
-                    dep_root = Tree("但是以下模组依赖它")
-                    for mod in the_mods_that_require_this_one:
-                        dep_root.add(f"{nodes[mod].title()}")
-                else:
-                    dep_root = f"但是 {nodes[the_mods_that_require_this_one[0]].title()} 依赖它"
+                root = Tree(f"[yellow]{title(id)} 与 {title(deps[0])} 不兼容[/yellow]")
+            dependents = dependents_tree(id)
+            if dependents:
+                root.add(dependents)
             errors.append(ModIncompatibleError(root))
 
-        # 创建可视化图
-        net = Network(width="100%", height="100vh", notebook=False, directed=True, cdn_resources='local')
-        net.from_nx(dependencies)
+        # 可视化图在后台生成，不耽误后续的下载
+        self.graph_future = self.__pool.submit(self.write_graph, graph_nodes, graph_edges)
 
-        net.write_html("dependencies.html", notebook=False, open_browser=False)
-        self.finalmsg.append("依赖图已保存")
+        def describe(error: Exception) -> Tree | str:
+            """
+            找不到的模组附上需要它的模组
+            """
+
+            if isinstance(error, ModNotFoundError):
+                root = Tree(f"[yellow]{error}[/yellow]")
+                dependents = dependents_tree(error.except_mod.slug_or_id)
+                if dependents:
+                    root.add(dependents)
+                return root
+            return describe_error(error)
 
         if errors:
-            e_tree = Tree("由于以下原因，将不会继续")
-            for error in errors:
-                if isinstance(error, ModNotFoundError):
-                    root = Tree(f"[yellow]{error}[/yellow]")
-                    the_mods_that_require_this_one = [_v for _u, _v, _dep in edges if _u == error.except_mod.id() and (_dep.dep_type == "required" or _dep.dep_type == "optional")]
-                    if the_mods_that_require_this_one:
-                        if len(the_mods_that_require_this_one) > 1:
-                            dep_root = Tree("但是以下模组依赖它")
-                            for mod in the_mods_that_require_this_one:
-                                dep_root.add(f"{nodes[mod].title()}")
-                        else:
-                            dep_root = f"但是 {nodes[the_mods_that_require_this_one[0]].title()} 依赖它"
-                        root.add(dep_root)
-                    e_tree.add(root)
-                    continue
-                for arg in error.args:
-                    if isinstance(arg, Tree):
-                        e_tree.add(arg)
-                    else:
-                        e_tree.add(f"[yellow]{arg}[/yellow]")
-            self.finalmsg.append(e_tree)
+            self.report_errors(errors, describe=describe)
             dep_desc = Tree("请参阅依赖图 [bold]dependencies.html[/bold]")
             dep_desc.add("[bold][#008000]绿色[/][/bold]节点代表清单中的模组")
             if "required" in self.met_condition:
@@ -392,48 +710,130 @@ class ModManager:
             if "incompatible" in self.met_condition:
                 dep_desc.add("[bold][#FF0000]红色[/][/bold]节点/箭头代表冲突项目")
             self.finalmsg.append(dep_desc)
+        elif snapshot:
+            snapshot.parent.mkdir(parents=True, exist_ok=True)
+            with open(snapshot, "wb") as f:
+                pickle.dump(self.all_mods, f)
 
         return errors
 
+    def graph_snapshot_path(self, allow_optional_mod: bool) -> Path:
+        """
+        依赖解析结果的缓存位置，由模组清单中各模组的版本和目标条件决定
+
+        只包含清单中模组的版本，间接依赖发布了新版本时不会察觉，要等缓存超过 GRAPH_TTL 后才会重新解析
+        """
+
+        key = json.dumps([
+            sorted(f"{mod.id()}:{mod.version_data()["id"]}" for mod in self.mods),
+            self.target_version,
+            self.target_loader,
+            self.require_client,
+            self.require_server,
+            allow_optional_mod,
+        ])
+        return cache_dir() / f"graph-{hashlib.sha256(key.encode()).hexdigest()}.pkl"
+
     def get_download_link(self) -> ProgressGen:
         errors: list[Exception] = []
-        with Progress(
-            TextColumn("[progress.description]{task.description}"),
-            BarColumn(),
-            MofNCompleteColumn(),
-            console=self.console
-        ) as progress:
+        with self.phase_progress() as progress:
             task_id = progress.add_task("获取下载链接", True, len(self.all_mods))
 
             # 多线程查找下载链接
             result = yield from self.handle_future(
-                [self.__pool.submit(mod.get_version, progress, self.rl) for mod in self.all_mods.values()], 
+                lambda mod: mod.get_version(progress, self.rl, self.session), 
+                self.all_mods.values(), 
                 progress, 
                 task_id
             )
             errors.extend(result)
 
             
-        if errors:
-            e_tree = Tree("由于以下原因，将不会继续")
-            for error in errors:
-                e_tree.add(f"[yellow]{error}[/yellow]")
-            self.finalmsg.append(e_tree)
+        self.report_errors(errors)
         return errors
 
-    def download_mods(self, mod_dir: str) -> ProgressGen:
+    def write_graph(self, nodes: dict[str, dict], edges: list[tuple[str, str, dict]]):
+        """
+        创建可视化图并写入 dependencies.html
+        """
+
+        net = Network(width="100%", height="100vh", notebook=False, directed=True, cdn_resources='local')
+        # 节点大小与边宽与 from_nx 的默认值一致
+        for id, attrs in nodes.items():
+            net.add_node(id, size=10, **attrs)
+        added = set(nodes)
+        for u, v, attrs in edges:
+            # 解析失败的模组没有节点信息，只显示ID
+            for id in (u, v):
+                if id not in added:
+                    net.add_node(id, size=10)
+                    added.add(id)
+            net.add_edge(u, v, width=1, **attrs)
+
+        net.write_html("dependencies.html", notebook=False, open_browser=False)
+
+    def download_ranged(self, url: str, path: Path, size: int, advance: Callable[[int], None]) -> bool:
+        """
+        用多个 Range 请求并发下载同一个文件，各段直接写入文件中对应的位置
+
+        return: 服务器是否支持分段下载，不支持时需要重新下载整个文件
+        """
+
+        with self.rl.download_slot():
+            head = self.session.head(url, allow_redirects=True, timeout=TIMEOUT)
+        if head.status_code != 200 or head.headers.get("Accept-Ranges") != "bytes":
+            return False
+
+        # 预先分配好整个文件
+        with open(path, "wb") as f:
+            preallocate(f, size)
+
+        # 有一段失败时通知其他段尽快停止
+        stop = threading.Event()
+
+        def fetch(start: int, end: int) -> bool:
+            with self.rl.download_slot(), self.session.get(url, headers={"Range": f"bytes={start}-{end}"}, stream=True, timeout=TIMEOUT) as r:
+                r.raise_for_status()
+                # 服务器忽略了 Range 时会返回整个文件，改为普通下载即可
+                if r.status_code != 206:
+                    return False
+                with open(path, "r+b") as f:
+                    f.seek(start)
+                    for chunk in iter_chunks(r, advance):
+                        if stop.is_set():
+                            break
+                        f.write(chunk)
+            return True
+
+        # 每个段各自占用请求名额，所以这里不能在外层再占用一个
+        with ThreadPoolExecutor(RANGE_PARTS) as pool:
+            futures = [pool.submit(fetch, start, min(start + RANGE_SIZE, size) - 1) for start in range(0, size, RANGE_SIZE)]
+            try:
+                for future in as_completed(futures):
+                    if not future.result():
+                        return False
+            finally:
+                # 取消还没开始的段，正在下载的段读到下一块时停止，不必等它们下载完
+                stop.set()
+                for future in futures:
+                    future.cancel()
+
+        return True
+
+    def download_mods(self, mod_dir: str, verify: bool = True) -> ProgressGen:
+        """
+        下载所有模组到 mod_dir，已经存在且与目标一致的文件会被跳过
+
+        verify: 是否校验已存在文件的哈希，为 False 时只比较文件大小
+        """
+
         # 转换为路径
         mod_path = Path(mod_dir)
         # 创建下载目录
         mod_path.mkdir(parents=True, exist_ok=True)
 
         errors: list[Exception] = []
-        with Progress(
-            TextColumn("[progress.description]{task.description}"),
-            BarColumn(),
-            MofNCompleteColumn(),
-            console=self.console
-        ) as progress:
+        with self.phase_progress() as progress:
             task_id = progress.add_task("下载模组", True, len(self.all_mods))
 
             with Progress(
@@ -446,58 +846,77 @@ class ModManager:
             ) as download_progress:
                 # 下载工具函数
                 def download(mod: Mod) -> str:
+                    # 还没有获取下载链接的模组在这里获取，不必等所有模组的链接都获取完才开始下载
+                    if not mod.file_data:
+                        mod.get_version(progress, self.rl, self.session)
                     if not mod.file_data:
                         raise ModError(f"模组 {mod.slug_or_id} 还未初始化")
+
+                    target = mod_path / mod.file_data["filename"]
+
+                    # 上次已经下载好的文件不必重新下载
+                    if target.is_file() and target.stat().st_size == mod.file_data["size"]:
+                        same = True
+                        if verify:
+                            with open(target, "rb") as f:
+                                same = hashlib.file_digest(f, "sha512").hexdigest() == mod.file_data["hashes"]["sha512"]
+                        if same:
+                            message = f"跳过 [bright_black]{mod.file_data["filename"]}[/bright_black] 已存在"
+                            progress.print(message)
+                            return message
+
                     _task_id = download_progress.add_task(mod.file_data["filename"], True, mod.file_data["size"])
 
+                    # 先写入临时文件，校验通过后才替换为正式文件
+                    part = target.with_name(target.name + ".part")
+
                     # 哈希器
                     hasher = hashlib.sha512()
-                    # 缓冲区
-                    buf = BytesIO()
-
-                    self.rl.wait()
-                    with requests.get(mod.file_data["url"], stream=True) as r:
-                        r.raise_for_status()
-                        for chunk in r.iter_content(chunk_size=1024):
-                            if not chunk:
-                                continue
-                            buf.write(chunk)
-                            hasher.update(chunk)
-                            download_progress.update(_task_id, advance=len(chunk))
-
-                    # 计算哈希
-                    actual = hasher.hexdigest().lower()
-                    if actual != mod.file_data["hashes"]["sha512"]:
-                        buf.close()
-                        raise ModError(f"{mod.file_data["filename"]} 的哈希校验失败")
-
-                    # 写入文件
-                    buf.seek(0)
-                    with open(mod_path / mod.file_data["filename"], "wb") as f:
-                        f.write(buf.getbuffer())
-                    buf.close()
+
+                    def advance(n: int):
+                        download_progress.update(_task_id, advance=n)
 
                     try:
-                        message = f"保存为 [bright_black]{(mod_path / mod.file_data["filename"]).relative_to(".")}[/bright_black]"
-                        progress.print(message)
-                    except ValueError:
-                        message = f"保存为 [bright_black]{(mod_path / mod.file_data["filename"])}[/bright_black]"
-                        progress.print(message)
+                        size = mod.file_data["size"]
+                        if size >= RANGE_THRESHOLD and self.download_ranged(mod.file_data["url"], part, size, advance):
+                            # 分段是乱序到达的，只能写完之后再计算哈希
+                            with open(part, "rb") as f:
+                                hasher = hashlib.file_digest(f, "sha512")
+                        else:
+                            # 服务器不支持分段下载而退回到这里时，分段已经计入的进度需要清零
+                            download_progress.reset(_task_id)
+                            with self.rl.download_slot(), self.session.get(mod.file_data["url"], stream=True, timeout=TIMEOUT) as r, open(part, "wb") as f:
+                                r.raise_for_status()
+                                preallocate(f, size)
+                                # 边下载边写入磁盘，不在内存中保留整个文件
+                                for chunk in iter_chunks(r, advance):
+                                    f.write(chunk)
+                                    hasher.update(chunk)
+
+                        # 计算哈希
+                        actual = hasher.hexdigest().lower()
+                        if actual != mod.file_data["hashes"]["sha512"]:
+                            raise ModError(f"{mod.file_data["filename"]} 的哈希校验失败")
+                    except BaseException as e:
+                        part.unlink(missing_ok=True)
+                        download_progress.remove_task(_task_id)
+                        # 网络问题只影响这一个模组，不必中止整个下载
+                        if isinstance(e, requests.RequestException):
+                            raise ModError(f"{mod.file_data["filename"]} 下载失败 {e}") from e
+                        raise
+
+                    part.replace(target)
+
+                    # 相对路径对 "." 取相对路径还是它自身，绝对路径则无法取，所以直接显示 target 即可
+                    message = f"保存为 [bright_black]{target}[/bright_black]"
+                    progress.print(message)
 
                     download_progress.remove_task(_task_id)
                     return message
 
                 # 多线程下载模组
-                result = yield from self.handle_future(
-                    [self.__pool.submit(download, mod) for mod in self.all_mods.values()], 
-                    progress, 
-                    task_id
-                )
+                result = yield from self.handle_future(download, self.all_mods.values(), progress, task_id)
                 errors.extend(result)
 
-        if errors:
-            e_tree = Tree("下载模组时遇到问题")
-            for error in errors:
-                e_tree.add(f"[yellow]{error}[/yellow]")
-            self.finalmsg.append(e_tree)
+        self.report_errors(errors, "下载模组时遇到问题")
         return errors
\ No newline at end of file
@@ -1,22 +1,170 @@
-from typing import Optional, TYPE_CHECKING, Literal, Generator
+from typing import Optional, TYPE_CHECKING, Literal, Generator, Sequence
+from contextlib import nullcontext
+from functools import cache
 if TYPE_CHECKING:
     from manager import RateLimiter
 from rich.progress import Progress
 import requests
+import random
+import time
 import re
 import json
+try:
+    # 可选依赖，解析大量版本信息时比标准库快得多
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 from moderr import ModError, SlugNotValid, ModNotFoundError
+from cache import CachedSession
 
 
 API = "https://api.modrinth.com/v2"
 
+# 这些状态码通常是暂时的，值得重试
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# Modrinth 的 slug 必须匹配如下正则表达式
+SLUG_RE = re.compile(r"[\w!@$()`.+,\"\-']{3,64}")
+# 批量接口每次请求的数量
+BULK_SIZE = 100
+# 项目与版本信息中实际用到的字段，其余的（简介、图库等）不必一直留在内存里
+PROJECT_KEYS = ("id", "slug", "title", "client_side", "server_side")
+VERSION_KEYS = ("id", "version_number", "dependencies", "files", "game_versions", "loaders")
+
+# 连接与读取的超时时间（秒），避免卡住的连接一直占用线程
+TIMEOUT = (5, 30)
+# Modrinth 要求请求带上能识别出项目的 User-Agent
+USER_AGENT = "peter2500zz/mod-auto-download/0.1.0"
+
+# 没有传入会话时使用的共享会话，直接调用 Mod 的方法时也能复用连接
+default_session = requests.Session()
+default_session.headers["User-Agent"] = USER_AGENT
+
+
+def api_get(
+    url: str,
+    params: Optional[dict] = None,
+    rl: Optional[RateLimiter] = None,
+    session: Optional[requests.Session] = None,
+    retries: int = 5,
+) -> requests.Response:
+    """
+    请求Modrinth的API，遇到限流或服务器错误时以指数退避加随机抖动重试
+
+    return: 最后一次请求的响应，状态码需要调用方自行检查
+    """
+
+    session = session or default_session
+    # 有效期内的缓存不是真正的请求，不必占用名额
+    if isinstance(session, CachedSession) and (cached := session.fresh(url, params)):
+        return cached
+
+    for attempt in range(retries):
+        delay = 0.25 * 2 ** attempt + random.random() * 0.25
+        try:
+            with rl.slot() if rl else nullcontext():
+                result = session.get(url, params=params, timeout=TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries - 1:
+                raise
+        else:
+            if result.status_code not in RETRY_STATUS or attempt == retries - 1:
+                return result
+            # 服务器告诉了我们要等多久
+            retry_after = result.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+
+        # 不占用请求名额地等待
+        time.sleep(delay)
+
+    raise ModError(f"请求 {url} 失败")
+
+
+def fetch_projects(
+    slugs_or_ids: Sequence[str],
+    rl: Optional[RateLimiter] = None,
+    session: Optional[requests.Session] = None,
+) -> dict[str, dict]:
+    """
+    通过批量接口获取多个项目的信息，每 BULK_SIZE 个项目只需要一次请求
+
+    return: 以项目ID和slug为键的项目信息，找不到的项目不会出现在其中
+    """
+
+    projects: dict[str, dict] = {}
+    # 排序后请求的 URL 与清单顺序无关，重复运行时能命中缓存
+    slugs_or_ids = sorted(set(slugs_or_ids))
+    for i in range(0, len(slugs_or_ids), BULK_SIZE):
+        result = api_get(API + "/projects", {"ids": json.dumps(slugs_or_ids[i:i + BULK_SIZE])}, rl, session)
+        if result.status_code != 200:
+            result.raise_for_status()
+
+        for project in json_loads(result.content):
+            projects[project["id"]] = project
+            # slug 不区分大小写
+            projects[project["slug"].lower()] = project
+
+    return projects
+
+
+@cache
+def version_params(game_version: str, loader: str) -> dict[str, str]:
+    """
+    同一次运行中所有模组的查询参数都相同，只序列化一次
+    """
+
+    return {
+        "loaders": json.dumps([loader]),
+        "game_versions": json.dumps([game_version]),
+        # 因为有的模组总是在开发版本，所以常态开启了
+        "featured": json.dumps(True),
+    }
+
+
+def fetch_versions(
+    slug_or_id: str,
+    game_version: str,
+    loader: str,
+    rl: Optional[RateLimiter] = None,
+    session: Optional[requests.Session] = None,
+) -> Optional[list[dict]]:
+    """
+    获取项目在给定游戏版本和加载器下的版本列表，接口同时接受项目ID和slug
+
+    return: 版本列表，项目不存在时为 None
+    """
+
+    result = api_get(API + f"/project/{slug_or_id}/version", version_params(game_version, loader), rl, session)
+
+    if result.status_code == 404:
+        return None
+    elif result.status_code != 200:
+        result.raise_for_status()
+
+    return json_loads(result.content)
+
+
 class Mod:
+    __slots__ = (
+        "slug_or_id",
+        "__project",
+        "__current_version",
+        "__version_for",
+        "file_data",
+        "__target_version",
+        "__target_loader",
+        "__require_client",
+        "__require_server",
+    )
+
     slug_or_id: str
     # 参见 https://docs.modrinth.com/api/operations/getproject/
     __project: Optional[dict]
     # 参见 https://docs.modrinth.com/api/operations/getprojectversions/
     __current_version: Optional[dict]
+    # 当前版本是按怎样的 (游戏版本, 加载器) 查到的
+    __version_for: Optional[tuple[str, str]]
     # 参见 https://docs.modrinth.com/api/operations/getversion/
     file_data: Optional[dict]
 
@@ -28,14 +176,16 @@ class Mod:
     def __init__(self, url: str) -> None:
         slug_or_id = url.split("/")[-1]
 
-        # Modrinth 的 slug 必须匹配如下正则表达式
-        if re.search(r"^[\w!@$()`.+,\"\-']{3,64}$", slug_or_id):
+        if SLUG_RE.fullmatch(slug_or_id):
             self.slug_or_id = slug_or_id
             self.__project = None
             self.__current_version = None
+            self.__version_for = None
             self.file_data = None
             self.__target_version = None
             self.__target_loader = None
+            self.__require_client = None
+            self.__require_server = None
 
         else:
             raise SlugNotValid(slug_or_id)
@@ -47,7 +197,8 @@ class Mod:
         require_client: bool = True, 
         require_server: bool = True, 
         progress: Optional[Progress] = None,
-        rl: Optional[RateLimiter] = None
+        rl: Optional[RateLimiter] = None,
+        session: Optional[requests.Session] = None
     ) -> str:
         """
         请求Modrinth的API来初始化自身信息
@@ -61,16 +212,35 @@ class Mod:
         if progress:
             progress.print(f"解析 [bright_black]{self.slug_or_id}[/bright_black]")
 
-        if rl:
-            rl.wait()
-        result = requests.get(API + f"/project/{self.slug_or_id}")
+        result = api_get(API + f"/project/{self.slug_or_id}", rl=rl, session=session)
 
         if result.status_code == 404:
             raise ModNotFoundError(f"无法找到模组 {self.slug_or_id}", self)
         elif result.status_code != 200:
             result.raise_for_status()
 
-        self.__project = result.json()
+        return self.load(json_loads(result.content), game_version, loader, require_client, require_server, progress)
+
+    def load(
+        self, 
+        project: Optional[dict], 
+        game_version: str, 
+        loader: str, 
+        require_client: bool = True, 
+        require_server: bool = True, 
+        progress: Optional[Progress] = None
+    ) -> str:
+        """
+        用已经获取到的项目信息初始化自身，不会发出请求
+        """
+
+        self.__target_version = game_version
+        self.__target_loader = loader
+        self.__require_client = require_client
+        self.__require_server = require_server
+
+        # 只保留用得到的字段
+        self.__project = {key: project[key] for key in PROJECT_KEYS if key in project} if project else None
 
         if self.__project:
             if require_client:
@@ -97,31 +267,33 @@ class Mod:
 
         raise ModError(f"{self.slug_or_id} 的数据解析失败")
 
-    def query_version(self, progress: Optional[Progress] = None, rl: Optional[RateLimiter] = None) -> str:
+    def query_version(
+        self, 
+        progress: Optional[Progress] = None, 
+        rl: Optional[RateLimiter] = None, 
+        session: Optional[requests.Session] = None, 
+        versions: Optional[list[dict]] = None
+    ) -> str:
         """
         根据给定游戏版本和加载器来查找最新的模组
+
+        versions: 预先获取好的版本列表，为空时会自行请求
         """
 
         loader = self.target_loader()
         game_version = self.target_version()
 
-        params = {
-            "loaders": json.dumps([loader]),
-            "game_versions": json.dumps([game_version]),
-            # 因为有的模组总是在开发版本，所以常态开启了
-            "featured": json.dumps(True),
-        }
-
-        if rl:
-            rl.wait()
-        result = requests.get(API + f"/project/{self.id()}/version", params=params)
+        # 目标没有变化时不必重新查询
+        if self.__current_version is not None and self.__version_for == (game_version, loader):
+            message = f"找到 [bright_black]{self.title()} {self.__current_version.get("version_number")}[/bright_black]"
+            if progress:
+                progress.print(message)
+            return message
 
-        if result.status_code == 404:
+        if versions is None:
+            versions = fetch_versions(self.id(), game_version, loader, rl, session)
+        if versions is None:
             raise self.__not_found()
-        elif result.status_code != 200:
-            result.raise_for_status()
-
-        versions: list[dict] = result.json()
 
         for version in versions:
             # 确认版本与加载器是否匹配
@@ -133,13 +305,14 @@ class Mod:
                 message = f"找到 [bright_black]{self.title()} {version.get("version_number")}[/bright_black]"
                 if progress:
                     progress.print(message)
-                self.__current_version = version
+                self.__current_version = {key: version[key] for key in VERSION_KEYS if key in version}
+                self.__version_for = (game_version, loader)
                 return message
 
         else:
             raise self.__not_found()
 
-    def get_version(self, progress: Optional[Progress] = None, rl: Optional[RateLimiter] = None) -> str:
+    def get_version(self, progress: Optional[Progress] = None, rl: Optional[RateLimiter] = None, session: Optional[requests.Session] = None) -> str:
         if not self.__project or not self.__current_version:
             self.__not_init()
 
@@ -147,18 +320,19 @@ class Mod:
         if progress:
             progress.print(message)
 
-        if rl:
-            rl.wait()
-        result = requests.get(API + f"/version/{self.__current_version.get("id")}")
+        # 版本列表中已经包含了文件信息，只有缺失时才单独请求
+        files = self.__current_version.get("files")
+        if files is None:
+            result = api_get(API + f"/version/{self.__current_version.get("id")}", rl=rl, session=session)
 
-        if result.status_code == 404:
-            raise ModNotFoundError(f"无法找到 {self.title()} {self.__current_version.get("version_number")} 版本的下载链接", self)
-        elif result.status_code != 200:
-            result.raise_for_status()
+            if result.status_code == 404:
+                raise ModNotFoundError(f"无法找到 {self.title()} {self.__current_version.get("version_number")} 版本的下载链接", self)
+            elif result.status_code != 200:
+                result.raise_for_status()
 
-        result_data: dict = result.json()
+            files = json_loads(result.content).get("files", [])
 
-        for file in result_data.get("files", []):
+        for file in files:
             self.file_data = file
 
             return message
@@ -213,19 +387,27 @@ class Mod:
     def version(self) -> str:
         return self.version_data()["version_number"]
 
-    def dependencies(self, rl: Optional[RateLimiter] = None) -> Generator[Dep, None, None]:
+    def dependencies(self, rl: Optional[RateLimiter] = None, session: Optional[requests.Session] = None) -> Generator[Dep, None, None]:
+        # 所有依赖的目标都与自身相同，只取一次
+        require_client = self.require_client()
+        require_server = self.require_server()
+        target_version = self.target_version()
+        target_loader = self.target_loader()
+
         for dep_data in self.version_data()["dependencies"]:
-            dep = generate_dep(dep_data, rl=rl)
+            dep = generate_dep(dep_data, rl=rl, session=session)
 
-            dep.require_client = self.require_client()
-            dep.require_server = self.require_server()
-            dep.target_version = self.target_version()
-            dep.target_loader = self.target_loader()
+            dep.require_client = require_client
+            dep.require_server = require_server
+            dep.target_version = target_version
+            dep.target_loader = target_loader
 
             yield dep
 
 
 class Dep:
+    __slots__ = ("id", "dep_type", "file_name", "require_client", "require_server", "target_version", "target_loader")
+
     id: str
     dep_type: Literal["required", "optional", "incompatible", "embedded"]
     file_name: str
@@ -238,52 +420,78 @@ class Dep:
     def __init__(self, id: str) -> None:
         self.id = id
 
-    def to_mod(self, progress: Optional[Progress] = None, rl: Optional[RateLimiter] = None) -> Mod:
+    def to_mod(
+        self, 
+        progress: Optional[Progress] = None, 
+        rl: Optional[RateLimiter] = None, 
+        session: Optional[requests.Session] = None, 
+        project: Optional[dict] = None,
+        versions: Optional[list[dict]] = None
+    ) -> Mod:
+        """
+        project: 批量获取到的项目信息，为空时会自行请求
+        versions: 预先获取好的版本列表，为空时会自行请求
+        """
+
         mod = Mod(self.id)
-        mod.init(
-            self.target_version,
-            self.target_loader,
-            self.require_client,
-            self.require_server,
-            progress=progress,
-            rl=rl
-        )
+        if project:
+            mod.load(
+                project,
+                self.target_version,
+                self.target_loader,
+                self.require_client,
+                self.require_server,
+                progress=progress
+            )
+        else:
+            mod.init(
+                self.target_version,
+                self.target_loader,
+                self.require_client,
+                self.require_server,
+                progress=progress,
+                rl=rl,
+                session=session
+            )
 
         mod.query_version(
             progress=progress,
-            rl=rl
+            rl=rl,
+            session=session,
+            versions=versions
         )
 
         return mod
 
 
 class ModDep(Dep):
-    pass
+    __slots__ = ()
 
 
 class VerDep(Dep):
-    def __init__(self, ver_id: str, rl: RateLimiter | None = None) -> None:
-        if rl:
-            rl.wait()
-        result = requests.get(API + f"/version/{ver_id}")
+    __slots__ = ()
+
+    def __init__(self, ver_id: str, rl: RateLimiter | None = None, session: requests.Session | None = None) -> None:
+        result = api_get(API + f"/version/{ver_id}", rl=rl, session=session)
 
         if result.status_code == 404:
-            raise ModNotFoundError(f"无法找到 {ver_id}", Mod("ver_id"))
+            raise ModNotFoundError(f"无法找到 {ver_id}", Mod(ver_id))
         elif result.status_code != 200:
             result.raise_for_status()
 
-        result_data: dict = result.json()
+        result_data: dict = json_loads(result.content)
 
         super().__init__(result_data["project_id"])
 
 
-def generate_dep(data: dict, rl: RateLimiter | None = None) -> Dep:
+def generate_dep(data: dict, rl: RateLimiter | None = None, session: requests.Session | None = None) -> Dep:
     dep: Dep
 
-    if id := data.get("version_id"):
-        dep = VerDep(id, rl=rl)
-    elif id := data.get("project_id"):
+    # 有项目ID时直接使用，只有仅给出版本ID时才需要请求版本信息来找到项目
+    if id := data.get("project_id"):
         dep = ModDep(id)
+    elif id := data.get("version_id"):
+        dep = VerDep(id, rl=rl, session=session)
     else:
         raise ModError("依赖无效")
 
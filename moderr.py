@@ -3,13 +3,24 @@ if TYPE_CHECKING:
     from mod import Mod
 
 class ModError(Exception):
-    pass
+    __slots__ = ()
 
 class SlugNotValid(ModError):
+    __slots__ = ("bad_slug",)
+
+    bad_slug: str
+
     def __init__(self, bad_slug: str) -> None:
-        super().__init__(f"{bad_slug} 是无效的 mod slug")
+        self.bad_slug = bad_slug
+        # 消息在真正需要输出时才生成
+        super().__init__(bad_slug)
+
+    def __str__(self) -> str:
+        return f"{self.bad_slug} 是无效的 mod slug"
 
 class ModNotFoundError(ModError):
+    __slots__ = ("except_mod",)
+
     except_mod: Mod
 
     def __init__(self, msg: str, except_mod: Mod) -> None:
@@ -17,5 +28,7 @@ class ModNotFoundError(ModError):
         super().__init__(msg)
 
 class ModIncompatibleError(ModError):
+    __slots__ = ()
+
     def __init__(self, *args: object) -> None:
         super().__init__(*args)
\ No newline at end of file